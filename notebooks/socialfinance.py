@@ -1,9 +1,104 @@
 # socialfinance.py  -- module for modeling contracts and bank funding structures
 
+import warnings
+from functools import cached_property, lru_cache
+from typing import NamedTuple
+
 import numpy as np
 import matplotlib.pyplot as plt
 from IPython.display import Markdown, display, Math
 
+import socialfinance_kernels as _k
+
+try:   # ahead-of-time build, see socialfinance_kernels.py
+    import sf_kernels
+except ImportError:
+    sf_kernels = None
+
+if sf_kernels is not None and (not hasattr(sf_kernels, 'source_hash')
+                               or sf_kernels.source_hash() != _k.SOURCE_HASH):
+    warnings.warn('sf_kernels was built from an older socialfinance_kernels.py and is '
+                  'ignored; rebuild it with `python socialfinance_kernels.py`')
+    sf_kernels = None
+
+if sf_kernels is not None:
+    from sf_kernels import abest_kernel, breturn_kernel, nreach_kernel
+    HAVE_KERNELS = True
+else:
+    try:
+        from numba import njit
+    except ImportError:   # numba is optional -- Bank falls back to plain NumPy
+        HAVE_KERNELS = False
+    else:
+        abest_kernel, breturn_kernel, nreach_kernel = (
+            njit(parallel=True, cache=True)(fn)
+            for fn in (_k.abest_kernel, _k.breturn_kernel, _k.nreach_kernel))
+        HAVE_KERNELS = True
+
+try:
+    import numexpr as ne
+except ImportError:   # numexpr is optional -- expressions are evaluated with NumPy
+    ne = None
+
+
+def _capped(cap, m, k):
+    '''min(cap, m*k) in one pass with numexpr if available'''
+    if ne is not None:
+        return ne.evaluate('where(cap < m*k, cap, m*k)', local_dict={'cap': cap, 'm': m, 'k': k})
+    return np.minimum(cap, m * k)
+
+
+def _lower_line(m, ame0, ame1, am0, am1):
+    '''min(ame0 + ame1*m, am0 + am1*m) in one numexpr pass, kept in m's dtype'''
+    c = m.dtype.type
+    return ne.evaluate('where(ame0 + ame1*m < am0 + am1*m, ame0 + ame1*m, am0 + am1*m)',
+                       local_dict={'m': m, 'ame0': c(ame0), 'ame1': c(ame1),
+                                   'am0': c(am0), 'am1': c(am1)})
+
+
+def _debt_equity(I, F, Im):
+    '''(I+F-Im)/Im in one pass with numexpr if available, NaN where Im is 0'''
+    nan = Im.dtype.type(np.nan)
+    if ne is not None:
+        return ne.evaluate('where(Im>0, (I+F-Im)/where(Im>0, Im, 1), nan)',
+                           local_dict={'I': I, 'F': F, 'Im': Im, 'nan': nan})
+    return np.where(Im > 0, (I + F - Im) / np.where(Im > 0, Im, 1), nan)
+
+
+@lru_cache(maxsize=None)
+def _unit_grid(n):
+    '''n evenly spaced points on [0, 1], shared read-only'''
+    u = np.linspace(0, 1, n)
+    u.flags.writeable = False
+    return u
+
+
+def _fill_linspace(buf, lo, hi):
+    '''np.linspace(lo, hi, buf.size) written into buf without allocating'''
+    np.multiply(_unit_grid(buf.size), hi - lo, out=buf)
+    buf += lo
+    return buf
+
+
+class _P(NamedTuple):
+    '''Bank parameters packed as floats for the compiled kernels'''
+    p: float
+    q: float
+    I: float
+    X: float
+    gam: float
+    beta: float
+    f: float
+    alpha: float
+    B0: float
+    F: float
+    K: float
+
+
+# the kernels unpack _P by position
+if _P._fields != _k.PARAMS:
+    raise ImportError('_P fields must be in the order of socialfinance_kernels.PARAMS')
+
 
 class Bank(object):
     ''' A Bank in a 'neighborhood' or 'zone'  where the representative 
@@ -15,7 +110,7 @@ class Bank(object):
     def __init__(self, A, beta): 
         self.A = A         # pledgeable assets (as array)
         self.gamma = 1.0   # cost of uninformed capital (1 + ru)
-        self.beta = beta   # cost of equity capital (1 + re)
+        self.beta = beta   # cost of equity capital (1 + re), a column if swept
         self.B0 = 30       # intercept monitoring intensity function
         self.alpha = 0.5   # slope monitoring intensity function
         self.X = 200       # project success return
@@ -27,6 +122,32 @@ class Bank(object):
         self.K = 12000     # Intermediary capital in each neighborhood.
         #self.M = self.minmon(A)
         self.Amax = 140    # used for plot limits  
+        self._m_grids = np.empty((2, 50), self._plot_dtype)   # plot grid buffers, reused
+        self._A_grid = np.empty(120, self._plot_dtype)        # by plotA and _plot_grid
+
+    @classmethod
+    def from_grid(cls, A, betas):
+        '''Banks for a sweep over betas: derived curves come back with one row per beta'''
+        return cls(A, np.asarray(betas, dtype=float))
+
+    # scalar parameters shown by print_params, in sorted order
+    _SCALAR_PARAMS = ('Amax', 'B0', 'F', 'I', 'K', 'X', 'alpha', 'beta', 'f', 'gamma', 'p', 'q')
+
+    # plot grids only need pixel resolution
+    _plot_dtype = np.float32
+
+    # memoized quantities derived from the parameters above
+    _DERIVED = ('_kernels_ok', '_params', '_AMe_coeffs', '_AM_coeffs', '_AM0', '_AMe0', '_mcross',
+                '_mmax', '_Across', '_Amin', '_Im_mon_coeffs', '_plot_grid')
+
+    def __setattr__(self, name, value):
+        '''Reassigning a parameter drops the memoized derived quantities'''
+        if name == 'beta' and np.ndim(value) > 0:
+            value = np.reshape(value, (-1, 1))   # one row per beta in a sweep
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            for key in self._DERIVED:
+                self.__dict__.pop(key, None)
 
     def B(self, m):
         '''Monitoring intensity function: B(m) is the private benefit borrower 
@@ -36,144 +157,249 @@ class Bank(object):
     def FC(self, N):  # Avg fixed cost per borrower if bank has N borrowers
         return self.F / N + self.f
 
+    @cached_property
+    def _AMe_coeffs(self):
+        '''Intercept and slope of AMe(m) = (p/(p-q)) B(m) - (pX - beta I) + m + f'''
+        p, q, I, X, beta, f = self.p, self.q, self.I, self.X, self.beta, self.f
+        return (p/(p-q)) * self.B0 - (p * X - beta * I) + f, 1 - self.alpha * p/(p-q)
+
+    @cached_property
+    def _AM_coeffs(self):
+        '''Intercept and slope of AM(m), which is affine in m like AMe(m)'''
+        p, q, I, X, gam, beta, f = self.p, self.q, self.I, self.X, self.gamma, self.beta, self.f
+        return ((p/(p-q)) * self.B0 - (p * X - gam * I) + f,
+                1 - self.alpha * p/(p-q) + ((beta - gam) / beta) * (q / (p - q)))
+
     def AMe(self, m): 
         '''Minimum collateral for non-leveraged or equity-only MFI '''
-        p, q, I, X, beta,f = self.p, self.q, self.I, self.X, self.beta, self.f    
-        return (p/(p-q)) * self.B(m)  - (p * X - beta * I) + m + f
+        c0, c1 = self._AMe_coeffs
+        return c0 + c1 * m
 
     def AM(self, m):
         '''Minimum collateral for leveraged MFI '''
-        p, q, I, X, gam, beta, f= self.p, self.q, self.I, self.X, self.gamma, self.beta, self.f  
-   
-        return (p/(p-q)) * self.B(m) - (p * X - gam * I) + m  \
-                  + ((beta - gam) / beta) * (q * m / (p - q)) + f
+        c0, c1 = self._AM_coeffs
+        return c0 + c1 * m
 
     def Abest(self, m):
         '''Lower of the two collateral requirements'''
+        m = np.asarray(m)
+        # the kernel is float64 only; plot grids in _plot_dtype are fused by numexpr
+        if self._kernels_ok and m.ndim == 1 and m.dtype == np.float64:
+            return abest_kernel(np.ascontiguousarray(m), *self._AMe_coeffs, *self._AM_coeffs)
+        if ne is not None and m.dtype == self._plot_dtype and np.ndim(self.beta) == 0:
+            return _lower_line(m, *self._AMe_coeffs, *self._AM_coeffs)
         return np.minimum(self.AMe(m), self.AM(m))
 
     def Im(self, m):
         '''Minimum required equity investment by monitor'''
         return (1/self.beta) * self.q * m / (self.p - self.q)
 
+    @cached_property
+    def _kernels_ok(self):
+        return HAVE_KERNELS and np.ndim(self.beta) == 0
+
+    @cached_property
+    def _params(self):
+        return _P(*(float(v) for v in (self.p, self.q, self.I, self.X, self.gamma, self.beta,
+                                       self.f, self.alpha, self.B0, self.F, self.K)))
+
+    @cached_property
+    def _AM0(self):
+        return self.AM(0)
+
+    @cached_property
+    def _AMe0(self):
+        return self.AMe(0)
+
+    @cached_property
+    def _Im_mon_coeffs(self):
+        '''Intercept and slope of Im(mon(A)), affine in A up to AM(0)'''
+        c1 = -self.q / ((self.alpha - 1) * self.beta * self.p + self.gamma * self.q)
+        return -c1 * self._AM0, c1
+
+    @cached_property
+    def _mcross(self):
+        return self.beta * self.I * (self.p - self.q) / self.q
+
+    @cached_property
+    def _mmax(self):
+        return self.p * self.X - self.beta * self.I - self.f
+
+    @cached_property
+    def _Across(self):
+        return self.AM(self.mcross())
+
+    @cached_property
+    def _Amin(self):
+        return self.AMe(self.mmax())
+
     def mcross(self):
         '''Monitoring level where equity only AMe and levered AM lines cross'''
-        return self.beta * self.I * (self.p - self.q) / self.q
+        return self._mcross
 
     def Across(self):
-        return self.AM(self.mcross())
+        return self._Across
 
     def mmax(self):
         '''Maximal monitoring at which equity-only monitor can just break even'''
-        return self.p * self.X - self.beta * self.I - self.f
+        return self._mmax
 
     def Amin(self):
         '''Lowest possible collateral requirement - at max feasible monitoring'''
-        return self.AMe(self.mmax())
+        return self._Amin
 
     def mon(self, A):
         '''optimal monitoring in leveraged MFI
            Zero if >A(0)'''
-        AHI = self.AM(0) 
-        return ( (AHI - A) * (self.beta * (self.p - self.q)) / 
-                 ((self.alpha - 1) * self.beta * self.p + self.gamma * self.q)   )
+        AHI = self._AM0
+        raw = ( (AHI - A) * (self.beta * (self.p - self.q)) / 
+                ((self.alpha - 1) * self.beta * self.p + self.gamma * self.q)   )
+        return np.where(A > AHI, 0.0, raw)
 
     def monE(self, A):
-        '''optimal monitoring in equity-only MFI'''
-        AHI = self.AMe(0)
-        return ( (AHI - A) * 
+        '''optimal monitoring in equity-only MFI
+           Zero if >AMe(0)'''
+        AHI = self._AMe0
+        raw = ( (AHI - A) * 
                 ((self.p - self.q) / (self.q + (self.alpha-1) * self.p))   )
+        return np.where(A > AHI, 0.0, raw)
 
     def minmon(self, A):
         return np.minimum(self.monE(A), self.mon(A))
 
+    def _check_single_beta(self, method):
+        '''plotIm and plotDE draw one bank; a beta sweep is only supported by plotA'''
+        if np.ndim(self.beta) > 0:
+            raise ValueError(f'{method} needs a single beta; plot each Bank of the sweep '
+                             f'separately or use plotA')
+
+    @cached_property
+    def _plot_grid(self):
+        '''A grid shared by the plots, with mon, monE and minmon on it: 100 points
+           from Amin to AM(0), as plotDE uses, then 20 more up to Amax for plotIm'''
+        A_ = self._A_grid
+        _fill_linspace(A_[:100], self._Amin, self._AM0)
+        _fill_linspace(A_[99:], self._AM0, max(self.Amax, self._AM0))
+        monA, monEA = self.mon(A_), self.monE(A_)
+        return A_, monA, monEA, np.minimum(monEA, monA)
+
     def breturn(self, A):
         ''' array of borrower returns by A'''
+        A = np.asarray(A)
         X, p, q, I, f, gam, beta = self.X, self.p, self.q, self.I, self.f, self.gamma, self.beta
 
-        br = [p * X - gam * I - f if a > self.AM(0) 
-            else p * X - gam * I - f - self.mon(a) * (1 + ((beta - gam) / beta) * (q / (p - q))) if (a <= self.AM(0)) and (a > self.Across()) 
-            else p * X - beta * I - f - self.monE(a) if (a <= self.Across()) and (a >= self.Amin()) 
-            else 0 
-            for a in A]
-        return np.array(br)
+        AM0, Across, Amin = self._AM0, self._Across, self._Amin
+        if self._kernels_ok and A.ndim == 1:
+            return breturn_kernel(np.ascontiguousarray(A, dtype=np.float64), self._params,
+                                   AM0, self._AMe0, Across, Amin)
+
+        # write each region straight into one preallocated output (zero below Amin)
+        br = np.zeros(np.broadcast_shapes(A.shape, np.shape(Across)))
+        np.copyto(br, p * X - gam * I - f, where=A > AM0)
+        np.copyto(br, p * X - gam * I - f - self.mon(A) * (1 + ((beta - gam) / beta) * (q / (p - q))),
+                  where=(A <= AM0) & (A > Across))
+        np.copyto(br, p * X - beta * I - f - self.monE(A),
+                  where=(A <= Across) & (A >= Amin))
+        return br
 
 
     def print_params(self):
         """
         Display scalar parameters alphabetically
         """
-        params = sorted(vars(self).items())
-        params_to_print = [f"{key} = {value}" for key, value in params if np.isscalar(value)]
-        print(', '.join(params_to_print))
+        def fmt(value):   # a swept beta prints as a flat list
+            return value if np.ndim(value) == 0 else np.ravel(value).tolist()
+        print(', '.join(f"{key} = {fmt(getattr(self, key))}" for key in self._SCALAR_PARAMS))
 
     
 
     def nreach(self,A):
         '''number of borrowers reached with K of intermediary capital at different A'''
+        A = np.asarray(A)
         K, F, I = self.K, self.F, self.I
 
-        nr = np.zeros(len(A))
-        for i, a in enumerate(A):
-            if a > self.AM(0):
-                nr[i] = np.nan
-            elif (a <= self.AM(0)) and (a > self.Across()):
-                nr[i] = K/( self.Im(self.mon(a)) -F )
-            elif (a <= self.Across()) and (a >= self.Amin()):
-                nr[i] = K/(I+F)
-            else:
-                nr[i] = 0
-        return nr
+        AM0, Across, Amin = self._AM0, self._Across, self._Amin
+        if self._kernels_ok and A.ndim == 1:
+            return nreach_kernel(np.ascontiguousarray(A, dtype=np.float64), self._params,
+                                  AM0, Across, Amin)
+
+        c0, c1 = self._Im_mon_coeffs
+        ImF = c0 + c1 * A - F
+        with np.errstate(divide='ignore', invalid='ignore'):
+            nr_lev = np.where(ImF != 0, K / ImF, np.nan)
+
+        condlist = [(A <= AM0) & (A > Across),
+                    (A <= Across) & (A >= Amin)]
+        choicelist = [nr_lev, K / (I + F)]
+        nr = np.select(condlist, choicelist, default=0.0)
+        return np.where(A > AM0, np.nan, nr)
     
-    def plotA(self):
-        '''Plot minimum collateral requirements'''
+    def plotA(self, ax=None):
+        '''Plot minimum collateral requirements, one set of lines per beta in a sweep.
+           Redraws on ax if given, e.g. from a slider callback'''
+        sweep = np.ndim(self.beta) > 0
         mc, mx = self.mcross(), self.mmax()
-        Am0, Amc, Amx = self.AM(0), self.AM(mc), self.AMe(mx)
-        mm, mm_ = np.linspace(0, self.Amax), np.linspace(0, mx)
+        Am0, Amc, Amx = self._AM0, self._Across, self._Amin
+        mm = _fill_linspace(self._m_grids[0], 0, self.Amax)
+        mm_ = _unit_grid(mm.size) * mx if sweep else _fill_linspace(self._m_grids[1], 0, mx)
         
-        fig, ax = plt.subplots(1)
-        ax.plot(mm, self.AMe(mm), label='equity only MFI', linestyle=':')
-        ax.plot(mm, self.AM(mm), label='leveraged MFI', linestyle=':')
-        ax.plot(mm_, self.Abest(mm_), linewidth=3.3) 
+        if ax is None:
+            fig, ax = plt.subplots(1)
+        else:
+            ax.clear()
+        rows = zip(np.ravel(self.beta), np.atleast_2d(self.AMe(mm)), np.atleast_2d(self.AM(mm)),
+                   np.atleast_2d(mm_), np.atleast_2d(self.Abest(mm_)))
+        for beta, AMe_m, AM_m, m_, Abest_m in rows:
+            tag = rf', $\beta$ = {beta:g}' if sweep else ''
+            ax.plot(mm, AMe_m, label='equity only MFI' + tag, linestyle=':')
+            ax.plot(mm, AM_m, label='leveraged MFI' + tag, linestyle=':')
+            ax.plot(m_, Abest_m, linewidth=3.3) 
         
-        ax.set(xlim=(0, 80), ylim=(0, self.AMe(0)), 
+        ax.set(xlim=(0, 80), ylim=(0, np.max(self._AMe0)), 
                title='Minimum Collateral requirement', 
                xlabel='monitoring intensity $m$', ylabel='pledgeable asset $A (m)$')
         
-        ax.text(1, Am0+5, 'No monitor', rotation='vertical', verticalalignment='bottom')
-        ax.text(1, (Amc+Am0)/2, 'Interme-\n diated', rotation='vertical', verticalalignment='center')
-        ax.text(1, (Amx+Amc)/2, 'Equity-only', rotation='vertical', verticalalignment='center')
-        ax.text(1, Amx/2, 'No Loan', rotation='vertical', verticalalignment='center')
-        ax.text(mx*1.1, self.AMe(mx)*0.9, r'$AM_e(m)$')
-        ax.text(mx*1.1, self.AM(mx), r'$AM(m)$')
-        
         ax.spines['right'].set_visible(False)
         ax.spines['top'].set_visible(False)
         
-        ax.vlines([mc, mx], ymin=0, ymax=[Amc, Amx], linestyle =':')
-        ax.hlines([Amc, Amx], xmin=0, xmax=[mc, mx], linestyle =':')
+        if not sweep:
+            ax.text(1, Am0+5, 'No monitor', rotation='vertical', verticalalignment='bottom')
+            ax.text(1, (Amc+Am0)/2, 'Interme-\n diated', rotation='vertical', verticalalignment='center')
+            ax.text(1, (Amx+Amc)/2, 'Equity-only', rotation='vertical', verticalalignment='center')
+            ax.text(1, Amx/2, 'No Loan', rotation='vertical', verticalalignment='center')
+            ax.text(mx*1.1, self.AMe(mx)*0.9, r'$AM_e(m)$')
+            ax.text(mx*1.1, self.AM(mx), r'$AM(m)$')
+        
+            ax.vlines([mc, mx], ymin=0, ymax=[Amc, Amx], linestyle =':')
+            ax.hlines([Amc, Amx], xmin=0, xmax=[mc, mx], linestyle =':')
         
         ax.legend(loc='upper right')
-        ax.set_ylim(0, self.AMe(0)+20)
+        ax.set_ylim(0, np.max(self._AMe0)+20)
     
-    def plotIm(self):
+    def plotIm(self, ax=None):
         '''
-        plot total investment share by intermediary and uninformed lenders'''
+        plot total investment share by intermediary and uninformed lenders
+        (redrawn on ax if given)'''
+        self._check_single_beta('plotIm')
         I, f, beta = self.I, self.f, self.beta
         mc, mx = self.mcross(), self.mmax()
-        Amc, Amx = self.AM(mc), self.Amax
+        Amc, Amx = self._Across, self.Amax
 
         amin = self.Amin()
-        A_ = np.linspace(amin, Amx, 100)  # color only loans
-        Im = np.minimum(I, self.minmon(A_) * (self.q / (self.p - self.q)) / beta )
-        Im1 = np.minimum(I, self.mon(A_) * (self.q / (self.p - self.q)) / beta )
+        A_, monA, monEA, minA = self._plot_grid  # color only loans
+        k = self._plot_dtype(self.q / ((self.p - self.q) * beta))
+        Im = _capped(I, minA, k)
+        Im1 = _capped(I, monA, k)
         #Im2 = np.minimum(I+f, self.monE(A_) * (self.q / (self.p - self.q)) / beta)
 
 
-        fig, ax = plt.subplots()
+        if ax is None:
+            fig, ax = plt.subplots()
+        else:
+            ax.clear()
         ax.plot(A_, Im, label=r'$I^m$ - monitoring equity')
-        ax.plot(A_, np.minimum(I - Im, I), label=r'$I^u$ - uninformed debt')
-        ax.plot(A_, self.minmon(A_), label=r'$m$ - monitoring');
+        ax.plot(A_, I - Im, label=r'$I^u$ - uninformed debt')
+        ax.plot(A_, minA, label=r'$m$ - monitoring');
 
   
         ax.plot(A_, Im1, label=r'$m$ - monitoring')
@@ -182,34 +408,42 @@ class Bank(object):
         ax.set_title(r'Required monitoring m and investment $I_m$')
         ax.set_xlabel('A -- pledgeable assets')
         ax.set_ylim(0, I  + 10)
-        ax.set_xlim(amin-10, max(A_))
+        ax.set_xlim(amin-10, self.Amax)
 
         ax.text(amin - 5, I, r'$I$')
         ax.text(amin + 2, I, r'$I^m$')
-        ax.text(amin + 2, self.monE(amin), 'm(A)')
+        ax.text(amin + 2, monEA[0], 'm(A)')
         ax.text(amin + 2, 2, r'$I^u =I-I^m$')
 
         ax.axvline(x=amin, linestyle=':')
         ax.axvline(x=Amc, linestyle=':')
-        ax.axvline(x=self.AM(0), linestyle=':')
+        ax.axvline(x=self._AM0, linestyle=':')
         ax.axhline(y=I , linestyle=':')
 
 
-    def plotDE(self,beta):
-        '''plot outside debt to monitored debt (I+F-Im)/Im ratio as a function of A'''
+    def plotDE(self,beta, ax=None):
+        '''plot outside debt to monitored debt (I+F-Im)/Im ratio as a function of A
+           on the current axes, or redrawn on ax if given'''
+        self._check_single_beta('plotDE')
+        if ax is None:
+            ax = plt.gca()
+        else:
+            ax.clear()
         amin = self.Amin()
-        A_ = np.linspace(amin, self.AM(0), 100)[:-1]  # remove Im=0 point
+        A_, _, _, minA = self._plot_grid
+        A_, minA = A_[:99], minA[:99]  # up to AM(0), less the Im=0 point
         p,q, I, F = self.p, self.q, self.I, self.F
-        plt.title('Debt to equity ratio:  ' + r'$\frac{I+F-I^m}{I^m}$')
-        Im = np.minimum(I + F, self.minmon(A_) * (q / (p - q)) * (1 / beta))
-        de = np.divide(I + F - Im, Im, where=Im>0)
-        plt.plot(A_, de)
-        plt.xlabel('A -- pledgeable assets')
-        plt.axvline(x=self.AM(self.mcross()), linestyle=':');
-        plt.axhline(y=0, linestyle=':');
-        plt.axvline(x=self.Amin(), linestyle=':')
-        plt.xlim(amin-10, 140);
-        plt.ylim(0, 20);
+        ax.set_title('Debt to equity ratio:  ' + r'$\frac{I+F-I^m}{I^m}$')
+        k = self._plot_dtype(q / ((p - q) * beta))
+        Im = _capped(I + F, minA, k)
+        de = _debt_equity(I, F, Im)
+        ax.plot(A_, de)
+        ax.set_xlabel('A -- pledgeable assets')
+        ax.axvline(x=self._Across, linestyle=':');
+        ax.axhline(y=0, linestyle=':');
+        ax.axvline(x=amin, linestyle=':')
+        ax.set_xlim(amin-10, 140);
+        ax.set_ylim(0, 20);
 
 if __name__ == '__main__':
     """Sample use of the bankzone class """
@@ -0,0 +1,94 @@
+# socialfinance_kernels.py  -- compiled loops behind Bank.Abest, Bank.breturn and Bank.nreach
+#
+# Build the ahead-of-time extension (sf_kernels) next to this file with
+#
+#     python socialfinance_kernels.py
+#
+# socialfinance.py imports sf_kernels when it exists and was built from the
+# current version of this file (see SOURCE_HASH), otherwise it JIT-compiles the
+# functions below with numba, otherwise it uses plain NumPy.
+#
+# The kernels are free functions of the parameter tuple rather than methods of a
+# numba jitclass: pycc cannot export jitclasses, and Bank keeps its memoized
+# derived values, beta sweeps and NumPy fallback in plain Python.
+
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+try:
+    from numba import prange
+except ImportError:   # keeps PARAMS importable without numba
+    prange = range
+
+# The kernels unpack P, the Bank parameter tuple, by position in this order;
+# socialfinance.py checks it against the fields of its _P NamedTuple.
+PARAMS = ('p', 'q', 'I', 'X', 'gam', 'beta', 'f', 'alpha', 'B0', 'F', 'K')
+
+# Fingerprint of this file, compiled into sf_kernels so a stale build is detected
+SOURCE_HASH = int(hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:15], 16)
+
+
+def abest_kernel(m, ame0, ame1, am0, am1):
+    '''Single-pass min(AMe(m), AM(m)) from their intercepts and slopes -- see Bank.Abest'''
+    Ab = np.empty(m.size)
+    for i in prange(m.size):
+        ame = ame0 + ame1 * m[i]
+        am = am0 + am1 * m[i]
+        Ab[i] = ame if ame < am else am
+    return Ab
+
+
+def breturn_kernel(A, P, AM0, AMe0, Across, Amin):
+    '''Single-pass borrower return by A -- see Bank.breturn'''
+    p, q, I, X, gam, beta, f, alpha, B0, F, K = P
+    cm = beta * (p - q) / ((alpha - 1) * beta * p + gam * q)
+    cme = (p - q) / (q + (alpha - 1) * p)
+    br = np.empty(A.size)
+    for i in prange(A.size):
+        a = A[i]
+        if a > AM0:
+            br[i] = p * X - gam * I - f
+        elif a > Across:
+            br[i] = p * X - gam * I - f - (AM0 - a) * cm * (1 + ((beta - gam) / beta) * (q / (p - q)))
+        elif a >= Amin:
+            br[i] = p * X - beta * I - f - ((AMe0 - a) * cme if a <= AMe0 else 0.0)
+        else:
+            br[i] = 0.0
+    return br
+
+
+def nreach_kernel(A, P, AM0, Across, Amin):
+    '''Single-pass number of borrowers reached by A -- see Bank.nreach'''
+    p, q, I, X, gam, beta, f, alpha, B0, F, K = P
+    c1 = -q / ((alpha - 1) * beta * p + gam * q)   # Im(mon(a)) = c0 + c1*a
+    c0 = -c1 * AM0
+    nr = np.empty(A.size)
+    for i in prange(A.size):
+        a = A[i]
+        if a > AM0:
+            nr[i] = np.nan
+        elif a > Across:
+            ImF = c0 + c1 * a - F
+            nr[i] = K / ImF if ImF != 0 else np.nan
+        elif a >= Amin:
+            nr[i] = K / (I + F)
+        else:
+            nr[i] = 0.0
+    return nr
+
+
+if __name__ == '__main__':
+    from numba.pycc import CC   # only the ahead-of-time build needs pycc
+
+    cc = CC('sf_kernels')
+    P = f'UniTuple(f8, {len(PARAMS)})'
+    cc.export('abest_kernel', 'f8[:](f8[:], f8, f8, f8, f8)')(abest_kernel)
+    cc.export('breturn_kernel', f'f8[:](f8[:], {P}, f8, f8, f8, f8)')(breturn_kernel)
+    cc.export('nreach_kernel', f'f8[:](f8[:], {P}, f8, f8, f8)')(nreach_kernel)
+
+    def source_hash():
+        return SOURCE_HASH
+    cc.export('source_hash', 'i8()')(source_hash)
+    cc.compile()